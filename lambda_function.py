@@ -6,12 +6,253 @@ month-to-date, daily, and forecasted costs. It then formats this data into a
 professional HTML report and sends it to a specified recipient via Amazon SES.
 """
 import os
+import json
+import hashlib
+import logging
+import re
 import datetime
+import math
+import heapq
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 import boto3
+import boto3.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-# Initialize AWS clients outside the handler for better performance
-ce = boto3.client('ce', region_name='ap-southeast-1')
-ses = boto3.client('ses', region_name='ap-southeast-1')
+# Lambda already routes the root logger to CloudWatch; messages below INFO are
+# dropped before they are formatted
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Shared by every AWS client; keeps connections alive and bounds how long a
+# throttled or stalled call can stretch the billed duration
+_CLIENT_CONFIG = Config(
+    retries={'max_attempts': 2, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=8,
+    max_pool_connections=10
+)
+
+# Shared across warm invocations; every account's Cost Explorer calls are
+# independent, so they run in parallel and the handler only waits for the
+# slowest one
+_POOL = ThreadPoolExecutor(max_workers=10)
+
+# Session name recorded in CloudTrail when assuming a role in another account
+_ROLE_SESSION_NAME = 'DailyCostReporter'
+
+
+# The success response never changes, so it is built once per container
+_OK_RESPONSE = {'statusCode': 200, 'body': 'Email sent successfully!'}
+
+# Number of services listed individually in the report
+_TOP_SERVICES = 10
+
+# Template data already built in this container, keyed by (account IDs, report
+# date); a retry or duplicate schedule on the same day skips the CE calls
+_REPORT_CACHE = {}
+
+
+# The constant parts of the report, split around the pieces that change so
+# they are never re-parsed; only the summary figures and rows are filled in
+_HEAD = """
+<html>
+<head>
+<style>
+    body { font-family: Arial, sans-serif; color: #333; margin: 0;
+           padding: 0; background-color: #f7f7f7;}
+    .container { max-width: 800px; margin: 20px auto; padding: 20px;
+                 border: 1px solid #ddd; border-radius: 8px;
+                 background-color: #fff; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
+    .header { font-size: 24px; color: #d9534f; border-bottom: 2px solid #f0f0f0;
+              padding-bottom: 10px; margin-bottom: 20px; }
+    .summary-box { display: flex; justify-content: space-around;
+                   background-color: #f9f9f9; padding: 20px; text-align: center;
+                   border-radius: 8px; margin-bottom: 30px; }
+    .summary-item h3 { margin: 0; font-size: 16px; color: #555; font-weight: normal; }
+    .summary-item p { margin: 5px 0 0; font-size: 28px; font-weight: bold;
+                      color: #0275d8; }
+    h2 { font-size: 20px; color: #333; border-bottom: 1px solid #eee;
+         padding-bottom: 5px; }
+    table { width: 100%; border-collapse: collapse; margin-top: 15px;}
+    th, td { padding: 12px; border: 1px solid #ddd; text-align: left; }
+    th { background-color: #f2f2f2; }
+    .bar-container { width: 100%; background-color: #f1f1f1;
+                     border-radius: 4px; height: 22px; }
+    .bar { height: 22px; background-color: #4CAF50; border-radius: 4px;
+           text-align: right; color: white; line-height: 22px; }
+</style>
+</head>
+<body>
+<div class="container">
+    <div class="header">AWS Cost Report</div>
+"""
+_SUMMARY_TPL = """    <div class="summary-box">
+        <div class="summary-item">
+            <h3>Month-to-Date Cost</h3>
+            <p>$%s</p>
+        </div>
+        <div class="summary-item">
+            <h3>Last 24h Cost</h3>
+            <p>$%s</p>
+        </div>
+        <div class="summary-item">
+            <h3>Forecasted Monthly Cost</h3>
+            <p>$%s</p>
+        </div>
+    </div>
+"""
+_TABLE_OPEN = """    <h2>Service-wise Cost Breakdown</h2>
+    <table>
+        <tr>
+            <th style="width:40%;">Service</th>
+            <th style="width:20%;">Cost (USD)</th>
+            <th>Cost Distribution</th>
+        </tr>
+"""
+_ACCOUNT_TPL = """    <h2>Account %s</h2>
+"""
+_TABLE_CLOSE = """    </table>
+"""
+_TAIL = """</div>
+</body>
+</html>
+"""
+
+# The skeleton registered as an SES template, so each send only carries
+# the changing figures and rows instead of the full HTML body
+_SES_TEMPLATE = {
+    'SubjectPart': 'AWS Cost Summary for {{account_id}} - {{date}}',
+    # Whitespace in the markup and CSS is insignificant, so it is collapsed to
+    # keep every delivered message smaller
+    'HtmlPart': re.sub(r'\s+', ' ', "".join([
+        _HEAD,
+        '{{#each accounts}}',
+        _ACCOUNT_TPL % '{{account_id}}',
+        _SUMMARY_TPL % ('{{total}}', '{{daily}}', '{{forecast}}'),
+        _TABLE_OPEN,
+        '{{#each rows}}<tr><td>{{service}}</td>'
+        '<td style="text-align: right;">${{cost}}</td>'
+        '<td><div class="bar-container"><div class="bar" '
+        'style="width: {{width}}%; background-color: #5cb85c;">'
+        '</div></div></td></tr>{{/each}}',
+        _TABLE_CLOSE,
+        '{{/each}}',
+        _TAIL,
+    ])).strip(),
+    # Plain-text alternative for clients that don't render HTML; SES sends
+    # both parts as multipart/alternative
+    'TextPart': (
+        'AWS Cost Report for {{account_id}} - {{date}}\n'
+        '{{#each accounts}}\n'
+        'Account {{account_id}}\n'
+        'Month-to-Date Cost: ${{total}}\n'
+        'Last 24h Cost: ${{daily}}\n'
+        'Forecasted Monthly Cost: ${{forecast}}\n'
+        'Service-wise Cost Breakdown\n'
+        '{{#each rows}}{{{service}}}: ${{cost}}\n{{/each}}'
+        '{{/each}}'
+    ),
+}
+# Named after a hash of its content, so a changed layout needs a fresh
+# registration instead of silently rendering with an outdated one
+_SES_TEMPLATE_NAME = 'DailyCostReport-' + hashlib.sha256(
+    json.dumps(_SES_TEMPLATE, sort_keys=True).encode('utf-8')
+).hexdigest()[:12]
+_SES_TEMPLATE['TemplateName'] = _SES_TEMPLATE_NAME
+
+
+@functools.lru_cache(maxsize=None)
+def _get_client(service_name):
+    """
+    Creates an AWS client on first use and reuses it across warm invocations.
+    Deferring this keeps boto3's service model loading out of the cold start
+    until the client is actually needed.
+    """
+    region = 'ap-southeast-1'
+    # Older boto3 releases (such as the one bundled with the Lambda runtime)
+    # send STS calls to the global endpoint; pin the regional one instead
+    endpoint_url = (
+        f'https://sts.{region}.amazonaws.com' if service_name == 'sts' else None
+    )
+    return boto3.client(
+        service_name,
+        region_name=region,
+        config=_CLIENT_CONFIG,
+        endpoint_url=endpoint_url
+    )
+
+
+# With SnapStart the init phase is snapshotted, so build the clients up front
+# and every restored container starts with them already constructed
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'snap-start':
+    _get_client('ce')
+    _get_client('ses')
+    if os.environ.get('ACCOUNTS'):
+        _get_client('sts')
+
+
+def _get_account_client(sts, service_name, role_arn):
+    """
+    Creates an AWS client for another account using temporary credentials
+    from assuming the given role. Runs on the thread pool, so the client is
+    built from its own session rather than boto3's shared default session.
+    """
+    credentials = sts.assume_role(
+        RoleArn=role_arn, RoleSessionName=_ROLE_SESSION_NAME
+    )['Credentials']
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken']
+    )
+    return session.client(
+        service_name, region_name='ap-southeast-1', config=_CLIENT_CONFIG
+    )
+
+
+def _submit_cost_queries(ce, start_of_month, end_of_period, forecast_end_date):
+    """
+    Submits one account's Cost Explorer calls to the thread pool and returns
+    the (breakdown, forecast) futures. Daily granularity gives both the
+    month-to-date breakdown and yesterday's cost from one (possibly
+    paginated) request.
+    """
+    return (
+        _POOL.submit(
+            _get_cost_and_usage_results,
+            ce,
+            TimePeriod={'Start': start_of_month, 'End': end_of_period},
+            Granularity='DAILY',
+            Metrics=['UnblendedCost'],
+            GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+        ),
+        _POOL.submit(
+            ce.get_cost_forecast,
+            TimePeriod={'Start': end_of_period, 'End': forecast_end_date},
+            Metric='UNBLENDED_COST',
+            Granularity='MONTHLY'
+        ),
+    )
+
+
+def _get_cost_and_usage_results(ce, **kwargs):
+    """
+    Calls GetCostAndUsage, following NextPageToken until every page has been
+    fetched, and returns the combined ResultsByTime entries. A single day's
+    groups can be split across pages, so entries may share a TimePeriod.
+    """
+    results = []
+    while True:
+        response = ce.get_cost_and_usage(**kwargs)
+        results.extend(response['ResultsByTime'])
+        if not response.get('NextPageToken'):
+            return results
+        kwargs['NextPageToken'] = response['NextPageToken']
 
 
 # pylint: disable=too-many-locals
@@ -24,166 +265,171 @@ def lambda_handler(_event, context):
         # --- 1. CONFIGURATION ---
         sender_email = os.environ.get('SENDER_EMAIL')
         recipient_email = os.environ.get('RECIPIENT_EMAIL')
-        aws_account_id = context.invoked_function_arn.split(":")[4]
+        # Optional JSON list of role ARNs, one per account to report on;
+        # without it the report covers the account running this function
+        role_arns = json.loads(os.environ.get('ACCOUNTS') or '[]')
+        account_ids = [
+            arn.split(":")[4]
+            for arn in role_arns or [context.invoked_function_arn]
+        ]
 
         # --- 2. DATE CALCULATIONS ---
-        today = datetime.datetime.now()
-        yesterday = today - datetime.timedelta(days=1)
-        start_of_month = today.strftime('%Y-%m-01')
-        end_of_period = today.strftime('%Y-%m-%d')
-        yesterday_str = yesterday.strftime('%Y-%m-%d')
-        future_date = today + datetime.timedelta(days=30)
-        forecast_end_date = future_date.strftime('%Y-%m-%d')
+        today = datetime.date.today()
+        start_of_month = today.replace(day=1).isoformat()
+        end_of_period = today.isoformat()
+        yesterday = (today - datetime.timedelta(days=1)).isoformat()
+        forecast_end_date = (today + datetime.timedelta(days=30)).isoformat()
+
+        cache_key = (tuple(account_ids), end_of_period)
+        template_data = _REPORT_CACHE.get(cache_key)
+        if template_data:
+            send_email(sender_email, recipient_email, template_data)
+            return _OK_RESPONSE
 
         # --- 3. AWS API CALLS ---
-        service_breakdown = ce.get_cost_and_usage(
-            TimePeriod={'Start': start_of_month, 'End': end_of_period},
-            Granularity='MONTHLY',
-            Metrics=['UnblendedCost'],
-            GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
-        )
-        forecast_response = ce.get_cost_forecast(
-            TimePeriod={'Start': end_of_period, 'End': forecast_end_date},
-            Metric='UNBLENDED_COST',
-            Granularity='MONTHLY'
-        )
-        forecasted_cost = float(forecast_response['Total']['Amount'])
-        daily_cost_response = ce.get_cost_and_usage(
-            TimePeriod={'Start': yesterday_str, 'End': end_of_period},
-            Granularity='DAILY',
-            Metrics=['UnblendedCost']
-        )
-        daily_cost = float(
-            daily_cost_response['ResultsByTime'][0]['Total']['UnblendedCost']['Amount']
-        ) if daily_cost_response['ResultsByTime'] else 0.0
+        # Roles are assumed in parallel, and each account's Cost Explorer
+        # calls are submitted as soon as its client is ready
+        if role_arns:
+            sts = _get_client('sts')
+            client_futures = {
+                _POOL.submit(_get_account_client, sts, 'ce', arn): index
+                for index, arn in enumerate(role_arns)
+            }
+            ce_clients = (
+                (client_futures[future], future.result())
+                for future in as_completed(client_futures)
+            )
+        else:
+            ce_clients = [(0, _get_client('ce'))]
+        futures = [None] * len(account_ids)
+        for index, ce in ce_clients:
+            futures[index] = _submit_cost_queries(
+                ce, start_of_month, end_of_period, forecast_end_date
+            )
 
         # --- 4. PROCESS DATA ---
-        service_costs, total_cost = {}, 0.0
-        for result in service_breakdown['ResultsByTime'][0]['Groups']:
-            service_name = result['Keys'][0]
-            cost_amount = float(result['Metrics']['UnblendedCost']['Amount'])
-            if cost_amount > 0.0:
-                service_costs[service_name] = cost_amount
-                total_cost += cost_amount
-
-        sorted_services = sorted(
-            service_costs.items(), key=lambda item: item[1], reverse=True
-        )
-        max_cost = sorted_services[0][1] if sorted_services else 1.0
+        accounts = [
+            summarize_costs(
+                account_id, yesterday,
+                breakdown_future.result(), forecast_future.result()
+            )
+            for account_id, (breakdown_future, forecast_future)
+            in zip(account_ids, futures)
+        ]
 
         # --- 5. BUILD AND SEND EMAIL ---
-        subject = f"AWS Cost Summary for {aws_account_id} - {end_of_period}"
-        body = build_html_body(
-            total_cost, forecasted_cost, daily_cost, sorted_services, max_cost
-        )
-        send_email(sender_email, recipient_email, subject, body)
-        return {'statusCode': 200, 'body': 'Email sent successfully!'}
+        template_data = build_template_data(end_of_period, accounts)
+        # Only keep the latest day's report so the cache can't grow over time
+        _REPORT_CACHE.clear()
+        _REPORT_CACHE[cache_key] = template_data
+        send_email(sender_email, recipient_email, template_data)
+        return _OK_RESPONSE
 
     # pylint: disable=broad-exception-caught
     except Exception as e:
-        print(f"An error occurred in the handler: {str(e)}")
-        return {'statusCode': 500, 'body': f'An error occurred: {str(e)}'}
-
-
-def build_html_body(total, forecast, daily, services, max_cost):
-    """
-    Builds the HTML content for the email report.
-    """
-    # Using a multi-line string for better readability
-    html_template = """
-    <html>
-    <head>
-    <style>
-        body {{ font-family: Arial, sans-serif; color: #333; margin: 0;
-               padding: 0; background-color: #f7f7f7;}}
-        .container {{ max-width: 800px; margin: 20px auto; padding: 20px;
-                     border: 1px solid #ddd; border-radius: 8px;
-                     background-color: #fff; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }}
-        .header {{ font-size: 24px; color: #d9534f; border-bottom: 2px solid #f0f0f0;
-                  padding-bottom: 10px; margin-bottom: 20px; }}
-        .summary-box {{ display: flex; justify-content: space-around;
-                       background-color: #f9f9f9; padding: 20px; text-align: center;
-                       border-radius: 8px; margin-bottom: 30px; }}
-        .summary-item h3 {{ margin: 0; font-size: 16px; color: #555; font-weight: normal; }}
-        .summary-item p {{ margin: 5px 0 0; font-size: 28px; font-weight: bold;
-                          color: #0275d8; }}
-        h2 {{ font-size: 20px; color: #333; border-bottom: 1px solid #eee;
-             padding-bottom: 5px; }}
-        table {{ width: 100%; border-collapse: collapse; margin-top: 15px;}}
-        th, td {{ padding: 12px; border: 1px solid #ddd; text-align: left; }}
-        th {{ background-color: #f2f2f2; }}
-        .bar-container {{ width: 100%; background-color: #f1f1f1;
-                         border-radius: 4px; height: 22px; }}
-        .bar {{ height: 22px; background-color: #4CAF50; border-radius: 4px;
-               text-align: right; color: white; line-height: 22px; }}
-    </style>
-    </head>
-    <body>
-    <div class="container">
-        <div class="header">AWS Cost Report</div>
-        <div class="summary-box">
-            <div class="summary-item">
-                <h3>Month-to-Date Cost</h3>
-                <p>${total:,.2f}</p>
-            </div>
-            <div class="summary-item">
-                <h3>Last 24h Cost</h3>
-                <p>${daily:,.2f}</p>
-            </div>
-            <div class="summary-item">
-                <h3>Forecasted Monthly Cost</h3>
-                <p>${forecast:,.2f}</p>
-            </div>
-        </div>
-        <h2>Service-wise Cost Breakdown</h2>
-        <table>
-            <tr>
-                <th style="width:40%;">Service</th>
-                <th style="width:20%;">Cost (USD)</th>
-                <th>Cost Distribution</th>
-            </tr>
-            {service_rows}
-        </table>
-    </div>
-    </body>
-    </html>
-    """
-
-    service_rows = ""
-    for service, cost in services:
-        bar_width = (cost / max_cost) * 100 if max_cost > 0 else 0
-        service_rows += f"""
-            <tr>
-                <td>{service}</td>
-                <td style="text-align: right;">${cost:,.2f}</td>
-                <td>
-                    <div class="bar-container">
-                        <div class="bar" style="width: {bar_width:.2f}%;
-                                                background-color: #5cb85c;"></div>
-                    </div>
-                </td>
-            </tr>
-        """
-    return html_template.format(
-        total=total, daily=daily, forecast=forecast, service_rows=service_rows
+        message = str(e)
+        logger.exception("An error occurred in the handler: %s", message)
+        return {'statusCode': 500, 'body': f'An error occurred: {message}'}
+
+
+def summarize_costs(account_id, yesterday, cost_results, forecast_response):
+    """
+    Reduces one account's Cost Explorer responses to the figures shown in
+    its section of the report.
+    """
+    month_costs = defaultdict(float)
+    day_costs = []
+    for day in cost_results:
+        for group in day['Groups']:
+            cost_amount = float(group['Metrics']['UnblendedCost']['Amount'])
+            month_costs[group['Keys'][0]] += cost_amount
+            if day['TimePeriod']['Start'] == yesterday:
+                day_costs.append(cost_amount)
+
+    service_costs = [pair for pair in month_costs.items() if pair[1] > 0.0]
+    total_cost = math.fsum(cost for _, cost in service_costs)
+
+    # Keep the report a fixed size: the top services get their own rows
+    # and everything else is rolled into a single "Other services" row
+    sorted_services = heapq.nlargest(
+        _TOP_SERVICES, service_costs, key=itemgetter(1)
     )
+    other_cost = total_cost - math.fsum(cost for _, cost in sorted_services)
+    if other_cost > 0.0:
+        sorted_services.append(('Other services', other_cost))
+
+    return {
+        'account_id': account_id,
+        'total': total_cost,
+        'daily': math.fsum(day_costs),
+        'forecast': float(forecast_response['Total']['Amount']),
+        'services': sorted_services,
+        'max_cost': max((cost for _, cost in sorted_services), default=1.0),
+    }
 
 
-def send_email(source, to, subject, body):
+def build_template_data(date, accounts):
     """
-    Sends an email using AWS SES.
+    Builds the JSON template data for the SES report template.
+    """
+    sections = []
+    for account in accounts:
+        max_cost = account['max_cost']
+        inv_max = 100.0 / max_cost if max_cost > 0 else 0.0
+        rows = [
+            {
+                'service': service,
+                'cost': f"{cost:,.2f}",
+                'width': f"{cost * inv_max:.2f}",
+            }
+            for service, cost in account['services']
+        ]
+        sections.append({
+            'account_id': account['account_id'],
+            'total': f"{account['total']:,.2f}",
+            'daily': f"{account['daily']:,.2f}",
+            'forecast': f"{account['forecast']:,.2f}",
+            'rows': rows,
+        })
+    return json.dumps({
+        'account_id': ', '.join(account['account_id'] for account in accounts),
+        'date': date,
+        'accounts': sections,
+    })
+
+
+def send_email(source, to, template_data):
+    """
+    Sends the report email using the registered AWS SES template.
     """
     try:
-        response = ses.send_email(
+        response = _get_client('ses').send_templated_email(
             Source=source,
             Destination={'ToAddresses': [to]},
-            Message={
-                'Subject': {'Data': subject, 'Charset': 'UTF-8'},
-                'Body': {'Html': {'Data': body, 'Charset': 'UTF-8'}}
-            }
+            Template=_SES_TEMPLATE_NAME,
+            TemplateData=template_data
         )
-        print(f"Email sent successfully. Message ID: {response['MessageId']}")
-    except Exception as e:
-        print(f"Error sending email: {str(e)}")
-        raise e
+        logger.info("Email sent successfully. Message ID: %s", response['MessageId'])
+    except ClientError as e:
+        # The handler logs the traceback; only note which step failed here
+        logger.error("Error sending email: %s", e)
+        raise
+
+
+def register_ses_template():
+    """
+    Registers the report template with SES. This is a deploy-time step, run
+    with `python lambda_function.py` whenever the template changes; the
+    handler itself only sends with the registered template.
+    """
+    ses = _get_client('ses')
+    try:
+        ses.create_template(Template=_SES_TEMPLATE)
+    except ses.exceptions.AlreadyExistsException:
+        # The name is a hash of the content, so it is already up to date
+        pass
+    return _SES_TEMPLATE_NAME
+
 
+if __name__ == '__main__':
+    print(f"SES template ready: {register_ses_template()}")